@@ -0,0 +1,99 @@
+import os
+import sqlite3
+from typing import Optional
+
+from dif import ImageHash
+
+DEFAULT_CACHE_PATH = os.path.expanduser("~/.cache/dif/hashes.sqlite")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS hashes (
+    path TEXT,
+    mtime REAL,
+    size INTEGER,
+    hash_size INTEGER,
+    algo TEXT,
+    hash BLOB,
+    PRIMARY KEY (path, hash_size, algo)
+)
+"""
+
+
+class HashCache:
+    """On-disk cache of image hashes.
+
+    Entries are keyed by path, hash size and algorithm, and only used while the
+    file's modification time and size are unchanged. The connection must be used
+    from the thread that created it.
+
+    Opening the cache raises OSError or sqlite3.Error if it cannot be created.
+    After that, the cache is best-effort: a failed lookup is a miss and a failed
+    write is skipped."""
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path)
+        try:
+            self._conn.execute(_SCHEMA)
+        except sqlite3.Error:
+            # E.g. the file exists but is not a database.
+            self._conn.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def get(self, file_path: str, hash_size: int, algo: str) -> Optional[ImageHash]:
+        """Get the cached hash of a file, or None if it is missing or outdated."""
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return None
+
+        try:
+            row = self._conn.execute(
+                "SELECT hash FROM hashes "
+                "WHERE path = ? AND mtime = ? AND size = ? AND hash_size = ? AND algo = ?",
+                (file_path, stat.st_mtime, stat.st_size, hash_size, algo),
+            ).fetchone()
+            if row is None:
+                return None
+            return ImageHash.from_bytes(row[0], hash_size)
+        except (sqlite3.Error, ValueError):
+            # Unreadable database or corrupted entry.
+            return None
+
+    def set(self, file_path: str, hash_size: int, algo: str, image_hash: ImageHash):
+        """Store the hash of a file. Changes are saved on commit."""
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return
+
+        try:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    file_path,
+                    stat.st_mtime,
+                    stat.st_size,
+                    hash_size,
+                    algo,
+                    image_hash.to_bytes(),
+                ),
+            )
+        except sqlite3.Error:
+            pass
+
+    def commit(self):
+        try:
+            self._conn.commit()
+        except sqlite3.Error:
+            pass
+
+    def close(self):
+        self.commit()
+        self._conn.close()
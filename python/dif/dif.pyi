@@ -1,10 +1,21 @@
+from typing import Callable, Optional
+
 class ImageHash:
     bool_values: list[bool]
     values: list[int]
     hash_size: int
 
+    def to_bytes(self) -> bytes: ...
+    @staticmethod
+    def from_bytes(data: bytes, hash_size: int) -> ImageHash: ...
     def distance(self, other: ImageHash) -> int: ...
+    def distances(self, others: list[ImageHash]) -> list[int]: ...
 
 def ahash(fpath: str, hash_size: int) -> ImageHash: ...
 def dhash(fpath: str, hash_size: int) -> ImageHash: ...
 def phash(fpath: str, hash_size: int, highfreq_factor: int) -> ImageHash: ...
+def find_duplicate_indices(
+    hashes: list[ImageHash],
+    max_bits: int,
+    increment_func: Optional[Callable[[int], object]] = None,
+) -> list[tuple[int, list[int]]]: ...
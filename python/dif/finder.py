@@ -1,51 +1,111 @@
-from collections import defaultdict
-import mimetypes
+from concurrent.futures import Future, ThreadPoolExecutor
+import math
 import os
-from typing import Annotated, Callable, Dict, List, Optional
+from typing import Annotated, Callable, Dict, Iterable, Iterator, List, Optional
 from typing_extensions import TypeVarTuple, Unpack
 
-from dif import ImageHash
+from dif import ImageHash, find_duplicate_indices
+from dif.cache import HashCache
 
 Path = Annotated[str, "Path to file"]
 FileHashes = Dict[Path, Optional[ImageHash]]
 FileDuplicates = Dict[Path, List[Path]]
 Ts = TypeVarTuple("Ts")
 
+# Formats that the image crate is able to decode.
+_IMAGE_EXTENSIONS = frozenset(
+    {
+        ".bmp",
+        ".gif",
+        ".ico",
+        ".jpeg",
+        ".jpg",
+        ".pbm",
+        ".pgm",
+        ".png",
+        ".pnm",
+        ".ppm",
+        ".tga",
+        ".tif",
+        ".tiff",
+        ".webp",
+    }
+)
+
+
+def _is_image(filename: str) -> bool:
+    return os.path.splitext(filename)[1].lower() in _IMAGE_EXTENSIONS
+
+
+def iter_images(folder: Path) -> Iterator[Path]:
+    """Lazily yield all image files from a folder and its subfolders."""
+    stack = [folder]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif _is_image(entry.name):
+                        yield entry.path
+        except OSError:
+            # Unreadable folders are skipped, just like os.walk does.
+            continue
+
 
 def get_all_images(folder: Path) -> List[str]:
     """Get all image files from a folder."""
-    image_paths: List[str] = []
-
-    for root, _, files in os.walk(folder):
-        full_root = os.path.join(folder, root)
-
-        for filename in files:
-            file_path = os.path.join(full_root, filename)
-            mime = mimetypes.guess_type(file_path)[0]
-            if not mime or not (mime and mime.startswith("image")):
-                continue
-
-            image_paths.append(file_path)
-    return image_paths
+    return list(iter_images(folder))
 
 
 def get_hashes(
-    image_paths: List[Path],
+    image_paths: Iterable[Path],
     hash_size: int,
     hash_func: Callable[[str, int, Unpack[Ts]], ImageHash],
     *args: Unpack[Ts],
     increment_func: Optional[Callable] = None,
+    max_workers: Optional[int] = None,
+    cache: Optional[HashCache] = None,
+    cache_key: Optional[str] = None,
 ) -> FileHashes:
+    """Hash all images concurrently, mapping unreadable images to None.
+
+    The hash functions release the GIL, so a thread pool is enough to use every core.
+    Images are submitted as soon as image_paths yields them, so a lazy iterable lets
+    hashing start before all images are found. Hashes found in cache are reused, and
+    new ones are stored in it. cache_key must identify hash_func and args."""
+    if cache and not cache_key:
+        raise ValueError("cache_key is required when using a cache")
+
     hashes: FileHashes = {}
-    for file_path in image_paths:
+    futures: Dict[Future, Path] = {}
+    with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+        for file_path in image_paths:
+            cached = cache.get(file_path, hash_size, cache_key) if cache else None
+            if cached is not None:
+                hashes[file_path] = cached
+                if increment_func:
+                    increment_func()
+                continue
+
+            future = executor.submit(hash_func, file_path, hash_size, *args)
+            if increment_func:
+                future.add_done_callback(lambda _: increment_func())
+            futures[future] = file_path
+
+    for future, file_path in futures.items():
         try:
-            hashes[file_path] = hash_func(file_path, hash_size, *args)
-        except:
+            hashes[file_path] = future.result()
+        except BaseException:
+            # Rust panics reach Python as PanicException, a BaseException.
             hashes[file_path] = None
+            continue
 
-        if increment_func:
-            increment_func()
+        if cache:
+            cache.set(file_path, hash_size, cache_key, hashes[file_path])
 
+    if cache:
+        cache.commit()
     return hashes
 
 
@@ -54,32 +114,32 @@ def find_duplicates(
     hashes: FileHashes,
     hash_size: int,
     threshold: float,
-    increment_func: Optional[Callable] = None,
+    increment_func: Optional[Callable[[int], object]] = None,
 ) -> FileDuplicates:
-    """Find duplicates from list of images."""
-    dups: FileDuplicates = defaultdict(list)
-
-    img_len = len(image_paths)
-    for i in range(img_len):
-        base = image_paths[i]
-        base_hash = hashes[base]
-        if base_hash is None:
-            if increment_func:
-                increment_func()
-            continue
-
-        for j in range(i + 1, img_len):
-            target = image_paths[j]
-            target_hash = hashes[target]
-            if target_hash is None:
-                continue
-
-            total_len = hash_size**2
-            if base_hash.distance(target_hash) / total_len < threshold:
-                dups[base].append(target)
-
-        if increment_func:
-            increment_func()
-
-    final_hashes = {k: v for k, v in dups.items() if len(v) >= 1}
-    return final_hashes
+    """Find duplicates from list of images.
+
+    increment_func is called with the number of images processed since its last
+    call, always from the calling thread."""
+    dups: FileDuplicates = {}
+
+    # Images that failed to hash are skipped, the rest are compared in Rust.
+    valid_paths: List[Path] = []
+    valid_hashes: List[ImageHash] = []
+    for path in image_paths:
+        image_hash = hashes[path]
+        if image_hash is not None:
+            valid_paths.append(path)
+            valid_hashes.append(image_hash)
+
+    skipped = len(image_paths) - len(valid_paths)
+    if increment_func and skipped:
+        increment_func(skipped)
+
+    # distance / total_len < threshold, as the most bits allowed to differ. A
+    # threshold of 0 still matches identical hashes.
+    max_bits = max(math.ceil(threshold * hash_size**2) - 1, 0)
+    for i, hits in find_duplicate_indices(valid_hashes, max_bits, increment_func):
+        if hits:
+            dups[valid_paths[i]] = [valid_paths[j] for j in hits]
+
+    return dups
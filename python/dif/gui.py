@@ -1,10 +1,29 @@
-import functools
 import os
 from pathlib import Path
-from typing import Set, cast
-
-from PyQt5.QtCore import Qt, QThread, pyqtSignal
-from PyQt5.QtGui import QPixmap, QDoubleValidator
+import sqlite3
+import threading
+import time
+from typing import Iterator, List, Optional, Set, cast
+
+from PyQt5.QtCore import (
+    QObject,
+    QPoint,
+    QRect,
+    QRunnable,
+    QSize,
+    Qt,
+    QThread,
+    QThreadPool,
+    QTimer,
+    pyqtSignal,
+)
+from PyQt5.QtGui import (
+    QDoubleValidator,
+    QImage,
+    QImageIOHandler,
+    QImageReader,
+    QPixmap,
+)
 from PyQt5.QtWidgets import (
     QApplication,
     QCheckBox,
@@ -24,8 +43,9 @@ from PyQt5.QtWidgets import (
     QComboBox,
 )
 from dif import ahash, dhash, phash
+from dif.cache import HashCache
 
-from dif.finder import FileDuplicates, find_duplicates, get_all_images, get_hashes
+from dif.finder import FileDuplicates, find_duplicates, get_hashes, iter_images
 
 
 def isValidFolder(folder):
@@ -39,6 +59,14 @@ class DuplicateWorker(QThread):
 
     # We track the progress count on a private variable.
     _progress = 0
+
+    # Emitting on every image floods the UI thread's event queue on big folders,
+    # so progress is only emitted every _emitEvery images or every EMIT_INTERVAL
+    # seconds, whichever comes first.
+    EMIT_INTERVAL = 0.05
+    _emitEvery = 1
+    _lastEmit = 0.0
+
     progress = pyqtSignal(int)
     totalImages = pyqtSignal(int)
     duplicateImages = pyqtSignal(dict)
@@ -50,68 +78,127 @@ class DuplicateWorker(QThread):
         threshold: float,
         method: str,
         *args,
+        maxWorkers: Optional[int] = None,
         **kwargs,
     ):
         self._folder = folder
         self._hashSize = hashSize
         self._method = method
         self._threshold = threshold
+        self._maxWorkers = maxWorkers
+        # Progress is updated from the hashing threads.
+        self._progressLock = threading.Lock()
         super().__init__(*args, **kwargs)
 
     def _updateProgress(self):
         """Updates the progress of worker and emits to signal."""
-        self._progress += 1
+        with self._progressLock:
+            self._progress += 1
+            now = time.monotonic()
+            if (
+                self._progress % self._emitEvery == 0
+                or now - self._lastEmit > self.EMIT_INTERVAL
+            ):
+                self._lastEmit = now
+                self.progress.emit(self._progress)
+
+    def _addProgress(self, amount: int):
+        """Adds to the progress of worker and emits to signal.
+
+        Only used by find_duplicates, which reports in batches from this thread."""
+        self._progress += amount
         self.progress.emit(self._progress)
 
-    def run(self):
-        imagePaths = get_all_images(self._folder)
-        self.totalImages.emit(len(imagePaths))
-
-        match self._method:
-            case "aHash":
-                hashes = get_hashes(
-                    imagePaths,
-                    self._hashSize,
-                    ahash,
-                    increment_func=self._updateProgress,
-                )
-            case "dHash":
-                hashes = get_hashes(
-                    imagePaths,
-                    self._hashSize,
-                    dhash,
-                    increment_func=self._updateProgress,
-                )
-            case "pHash":
-                hashes = get_hashes(
-                    imagePaths,
-                    self._hashSize,
-                    phash,
-                    4,
-                    increment_func=self._updateProgress,
-                )
-            case _:
-                raise Exception("Unexpected method")
-
+    def _resetProgress(self):
+        """Resets the progress of worker back to 0."""
         self._progress = 0
+        self._lastEmit = 0.0
         self.progress.emit(0)
 
-        self.duplicateImages.emit(
-            find_duplicates(
-                imagePaths,
-                hashes,
-                self._hashSize,
-                (1 - self._threshold),
-                increment_func=self._updateProgress,
-            )
+    def _iterImages(self, imagePaths: List[str]) -> Iterator[str]:
+        """Yields images as they are found, keeping track of them in imagePaths."""
+        lastEmit = 0.0
+        for imagePath in iter_images(self._folder):
+            imagePaths.append(imagePath)
+            self._emitEvery = max(1, len(imagePaths) // 200)
+
+            now = time.monotonic()
+            if now - lastEmit > self.EMIT_INTERVAL:
+                lastEmit = now
+                self.totalImages.emit(len(imagePaths))
+            yield imagePath
+
+        self.totalImages.emit(len(imagePaths))
+
+    def run(self):
+        # Hashing starts while the folder is still being walked, so the total
+        # grows as more images are found.
+        imagePaths: List[str] = []
+        images = self._iterImages(imagePaths)
+
+        # Unchanged images are not hashed again on later runs. The cache is only
+        # an optimization, so images are still hashed when it cannot be opened.
+        cache: Optional[HashCache]
+        try:
+            cache = HashCache()
+        except (OSError, sqlite3.Error):
+            cache = None
+
+        try:
+            match self._method:
+                case "aHash":
+                    hashes = get_hashes(
+                        images,
+                        self._hashSize,
+                        ahash,
+                        increment_func=self._updateProgress,
+                        max_workers=self._maxWorkers,
+                        cache=cache,
+                        cache_key="ahash",
+                    )
+                case "dHash":
+                    hashes = get_hashes(
+                        images,
+                        self._hashSize,
+                        dhash,
+                        increment_func=self._updateProgress,
+                        max_workers=self._maxWorkers,
+                        cache=cache,
+                        cache_key="dhash",
+                    )
+                case "pHash":
+                    hashes = get_hashes(
+                        images,
+                        self._hashSize,
+                        phash,
+                        4,
+                        increment_func=self._updateProgress,
+                        max_workers=self._maxWorkers,
+                        cache=cache,
+                        cache_key="phash:4",
+                    )
+                case _:
+                    raise Exception("Unexpected method")
+        finally:
+            if cache is not None:
+                cache.close()
+
+        self._resetProgress()
+
+        duplicates = find_duplicates(
+            imagePaths,
+            hashes,
+            self._hashSize,
+            (1 - self._threshold),
+            increment_func=self._addProgress,
         )
+        self.duplicateImages.emit(duplicates)
 
 
 class ImagePopup(QWidget):
     def __init__(self, imagePixmap: QPixmap, text=None, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.imagePixmap = imagePixmap
-        self.imw, self.imh = self.imagePixmap.width(), self.imagePixmap.height()
 
         self.imageLabel = QLabel(self)
         self.imageLabel.setPixmap(self.imagePixmap)
@@ -119,39 +206,110 @@ class ImagePopup(QWidget):
         # Align to top so that upon resize the image doesnt get drown out of window.
         self.imageLabel.setAlignment(Qt.AlignmentFlag(Qt.AlignTop | Qt.AlignHCenter))
 
+        self.resizeTimer = QTimer(self)
+        self.resizeTimer.setSingleShot(True)
+        self.resizeTimer.setInterval(50)
+        self.resizeTimer.timeout.connect(self._rescaleImage)
+
         if text:
             self.setWindowTitle(text)
         else:
             self.setWindowTitle("View Image")
 
     def resizeEvent(self, _):
+        self.imageLabel.setGeometry(0, 0, self.width(), self.height())
+        # Rescaling is only done once the user stops resizing the window.
+        self.resizeTimer.start()
+
+    def _rescaleImage(self):
         # Upon resize, we want the entire image to still be visible in the window,
         # so we resize it while keeping its aspect ratio.
-        w, h = self.width(), self.height()
-
-        # This is ultimately way too complicated, but it's purpose is to
-        # scale the image based on the window's height.
-        scaleDenominator = self.imh // h
-        scaledWidth = self.imw // scaleDenominator
         resizedPixmap = self.imagePixmap.scaled(
-            scaledWidth, h, Qt.AspectRatioMode.KeepAspectRatio
+            self.size(), Qt.KeepAspectRatio, Qt.SmoothTransformation
         )
         self.imageLabel.setPixmap(resizedPixmap)
-        self.imageLabel.setGeometry(0, 0, w, h)
+
+
+class ThumbnailSignals(QObject):
+    loaded = pyqtSignal(QImage, QSize)
+
+
+class ThumbnailLoader(QRunnable):
+    """Decodes and scales an image on a pool thread.
+
+    QPixmap can only be used on the UI thread, so the thumbnail is sent back as QImage
+    together with the image's full resolution."""
+
+    def __init__(self, imagePath: str, thumbnailSize: QSize):
+        super().__init__()
+        self.imagePath = imagePath
+        self.thumbnailSize = thumbnailSize
+        self.signals = ThumbnailSignals()
+
+    def run(self):
+        reader = QImageReader(self.imagePath)
+        reader.setAutoTransform(True)
+
+        storedSize = reader.size()
+        if not storedSize.isValid():
+            # The format can't tell its size without decoding, so decode it whole.
+            image = reader.read()
+            thumbnail = image.scaled(
+                self.thumbnailSize, Qt.KeepAspectRatio, Qt.SmoothTransformation
+            )
+            self.signals.loaded.emit(thumbnail, image.size())
+            return
+
+        # Let the decoder scale the image while reading it, which for JPEG skips
+        # most of the work of decoding at full resolution. The scaled size applies
+        # to the image as stored, before it gets rotated.
+        rotated = reader.transformation() & QImageIOHandler.TransformationRotate90
+        targetSize = self.thumbnailSize.transposed() if rotated else self.thumbnailSize
+        reader.setScaledSize(storedSize.scaled(targetSize, Qt.KeepAspectRatio))
+
+        fullSize = storedSize.transposed() if rotated else storedSize
+        self.signals.loaded.emit(reader.read(), fullSize)
 
 
 class QImageLabel(QLabel):
+    """Image thumbnail which is only decoded once loadThumbnail is called."""
+
+    resolutionLoaded = pyqtSignal(int, int)
+
     def __init__(self, imagePath: str, w: int, h: int, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
         self.imagePath = imagePath
-        self.imagePixmap = QPixmap(imagePath)
-        self.setPixmap(self.imagePixmap.scaled(w, h, Qt.KeepAspectRatio))
+        self.thumbnailSize = QSize(w, h)
+        self.thumbnailRequested = False
+
+        # Reserve the thumbnail's space so that the layout doesn't jump around
+        # as thumbnails come in.
+        self.setMinimumSize(self.thumbnailSize)
+        self.setAlignment(Qt.AlignCenter)
+        self.setText("Loading...")
+
+    def loadThumbnail(self):
+        if self.thumbnailRequested:
+            return
+
+        self.thumbnailRequested = True
+        loader = ThumbnailLoader(self.imagePath, self.thumbnailSize)
+        loader.signals.loaded.connect(self._setThumbnail)
+        QThreadPool.globalInstance().start(loader)
+
+    def _setThumbnail(self, thumbnail: QImage, fullSize: QSize):
+        self.setPixmap(QPixmap.fromImage(thumbnail))
+        self.resolutionLoaded.emit(fullSize.width(), fullSize.height())
 
     def mousePressEvent(self, ev):
-        self.popup = ImagePopup(self.imagePixmap, text=f"Image {self.imagePath}")
+        # Only the popup needs the image at full resolution.
+        reader = QImageReader(self.imagePath)
+        reader.setAutoTransform(True)
+        imagePixmap = QPixmap.fromImage(reader.read())
+        self.popup = ImagePopup(imagePixmap, text=f"Image {self.imagePath}")
 
-        w, h = self.imagePixmap.width(), self.imagePixmap.height()
+        w, h = imagePixmap.width(), imagePixmap.height()
         self.popup.setGeometry(0, 0, w, h)
         self.popup.show()
 
@@ -175,6 +333,9 @@ class Window(QMainWindow):
 
         self.setWindowTitle("Duplicate Image Finder")
 
+        # Thumbnails that haven't been scrolled into view yet.
+        self._pendingImages: List[QImageLabel] = []
+
         # Create all the necessary layout and widgets.
         self.createSensitivityRow()
         self.createFolderSelect()
@@ -278,9 +439,15 @@ class Window(QMainWindow):
             self.markedData.discard(checkBox.imagePath)
 
     def _cleanupDuplicateArea(self):
-        layout = self.imagesLayout
-        for i in reversed(range(layout.count())):
-            layout.itemAt(i).widget().deleteLater()
+        # Swap in a fresh container instead of removing results one by one, so Qt
+        # destroys all of the previous widgets in a single batch.
+        self.imagesScrollArea.takeWidget().deleteLater()
+        self._pendingImages = []
+
+        self.widget = QWidget()
+        self.imagesLayout = QVBoxLayout()
+        self.widget.setLayout(self.imagesLayout)
+        self.imagesScrollArea.setWidget(self.widget)
 
     def showDuplicateImages(self, duplicates: FileDuplicates):
         """Show all result from duplicate image worker.
@@ -298,8 +465,7 @@ class Window(QMainWindow):
             self.progressBar.reset()
             return
 
-        total = functools.reduce(lambda x, y: x + len(y), duplicates.values(), 0)
-        total += len(duplicates)
+        total = sum(map(len, duplicates.values())) + len(duplicates)
 
         if total > 100:
             result = QMessageBox.warning(
@@ -333,11 +499,17 @@ class Window(QMainWindow):
                 picLayout = QVBoxLayout()
                 picLayout.setAlignment(Qt.AlignCenter)
 
-                # Image + resolution label
+                # Image + resolution label, both filled in once the image is
+                # scrolled into view.
                 picLabel = QImageLabel(str(f), w, h)
-                w, h = picLabel.imagePixmap.width(), picLabel.imagePixmap.height()
-                resoLabel = QLabel(f"{w}x{h}")
+                resoLabel = QLabel()
                 resoLabel.setAlignment(Qt.AlignHCenter)
+                picLabel.resolutionLoaded.connect(
+                    lambda width, height, label=resoLabel: label.setText(
+                        f"{width}x{height}"
+                    )
+                )
+                self._pendingImages.append(picLabel)
 
                 # Deletion checkbox
                 picCheckbox = QImageMarker(str(f), "Mark for deletion")
@@ -352,6 +524,23 @@ class Window(QMainWindow):
             imageFrame.setLayout(imageFrameLayout)
             self.imagesLayout.addWidget(imageFrame)
 
+        # Wait for the layout to settle before checking what's visible.
+        QTimer.singleShot(0, self._loadVisibleImages)
+
+    def _loadVisibleImages(self):
+        """Starts loading the thumbnails that are currently inside the viewport."""
+        viewport = self.imagesScrollArea.viewport()
+        viewportRect = viewport.rect()
+
+        pendingImages = []
+        for picLabel in self._pendingImages:
+            labelRect = QRect(picLabel.mapTo(viewport, QPoint(0, 0)), picLabel.size())
+            if labelRect.intersects(viewportRect):
+                picLabel.loadThumbnail()
+            else:
+                pendingImages.append(picLabel)
+        self._pendingImages = pendingImages
+
     def createSensitivityRow(self):
         methodLabel = QLabel("Method:")
         hashSizeLabel = QLabel("Hash size:")
@@ -400,6 +589,11 @@ class Window(QMainWindow):
         self.imagesScrollArea = QScrollArea()
         self.imagesScrollArea.setWidgetResizable(True)
 
+        # Thumbnails are only loaded as they get scrolled into view.
+        scrollBar = self.imagesScrollArea.verticalScrollBar()
+        scrollBar.valueChanged.connect(self._loadVisibleImages)
+        scrollBar.rangeChanged.connect(self._loadVisibleImages)
+
         self.widget = QWidget()
         self.imagesLayout = QVBoxLayout()
 
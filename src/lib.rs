@@ -1,24 +1,61 @@
-use std::f64::consts::PI;
+use std::{
+    collections::HashMap,
+    f64::consts::PI,
+    fs::File,
+    io::BufReader,
+    sync::{
+        atomic::{AtomicUsize, Ordering},
+        mpsc::{self, RecvTimeoutError},
+    },
+    thread,
+    time::Duration,
+};
 
-use pyo3::{exceptions::PyValueError, prelude::*};
+use image::{DynamicImage, ImageFormat};
+
+use pyo3::{exceptions::PyValueError, prelude::*, types::PyBytes};
+use rayon::prelude::*;
 
 #[pyclass]
 struct ImageHash {
-    bool_values: Vec<bool>,
-    values: Vec<u8>,
+    // Bit `c` of the hash lives at bit `c % 64` of `bits[c / 64]`.
+    bits: Vec<u64>,
     hash_size: usize,
 }
 
+impl ImageHash {
+    fn from_bools(bool_values: &[bool], hash_size: usize) -> ImageHash {
+        let mut bits = vec![0u64; (bool_values.len() + 63) / 64];
+        for (c, &value) in bool_values.iter().enumerate() {
+            if value {
+                bits[c / 64] |= 1 << (c % 64);
+            }
+        }
+
+        ImageHash { bits, hash_size }
+    }
+
+    fn bytes(&self) -> Vec<u8> {
+        self.bits
+            .iter()
+            .flat_map(|word| word.to_le_bytes())
+            .take(self.hash_size.pow(2) / 8)
+            .collect()
+    }
+}
+
 #[pymethods]
 impl ImageHash {
     #[getter]
     fn get_bool_values(&self) -> PyResult<Vec<bool>> {
-        Ok(self.bool_values.clone())
+        Ok((0..self.hash_size.pow(2))
+            .map(|c| (self.bits[c / 64] >> (c % 64)) & 1 == 1)
+            .collect())
     }
 
     #[getter]
     fn get_values(&self) -> PyResult<Vec<u8>> {
-        Ok(self.values.clone())
+        Ok(self.bytes())
     }
 
     #[getter]
@@ -26,28 +63,302 @@ impl ImageHash {
         Ok(self.hash_size)
     }
 
+    // Little-endian packed hash, same layout as `values`.
+    fn to_bytes<'py>(&self, py: Python<'py>) -> &'py PyBytes {
+        PyBytes::new(py, &self.bytes())
+    }
+
+    // Inverse of `to_bytes`.
+    #[staticmethod]
+    fn from_bytes(data: &[u8], hash_size: usize) -> PyResult<ImageHash> {
+        if data.len() != hash_size.pow(2) / 8 {
+            return Err(PyValueError::new_err("Unmatch size"));
+        }
+
+        let mut bits = vec![0u64; (hash_size.pow(2) + 63) / 64];
+        for (k, &byte) in data.iter().enumerate() {
+            bits[k / 8] |= (byte as u64) << (k % 8 * 8);
+        }
+
+        Ok(ImageHash { bits, hash_size })
+    }
+
     pub fn distance(&self, other: &ImageHash) -> PyResult<u32> {
         if self.hash_size != other.hash_size {
             return Err(PyValueError::new_err("Unmatch size"));
         }
 
-        let mut count = 0;
-        let mut i: usize = 0;
-        while i < self.hash_size.pow(2) {
-            if self.bool_values.get(i).unwrap() != other.bool_values.get(i).unwrap() {
-                count += 1
-            };
-            i += 1;
+        Ok(hamming(&self.bits, &other.bits))
+    }
+
+    // Distance to every hash in `others`, in a single call.
+    pub fn distances(&self, others: Vec<PyRef<ImageHash>>) -> PyResult<Vec<u32>> {
+        if others.iter().any(|other| self.hash_size != other.hash_size) {
+            return Err(PyValueError::new_err("Unmatch size"));
+        }
+
+        Ok(others
+            .iter()
+            .map(|other| hamming(&self.bits, &other.bits))
+            .collect())
+    }
+}
+
+fn hamming(a: &[u64], b: &[u64]) -> u32 {
+    a.iter().zip(b).map(|(x, y)| (x ^ y).count_ones()).sum()
+}
+
+// Hashes of the same size stored back to back in a single buffer, so scanning
+// through them walks contiguous memory instead of chasing one allocation per hash.
+struct HashMatrix {
+    data: Vec<u64>,
+    words: usize,
+    len: usize,
+}
+
+impl HashMatrix {
+    fn new<H: std::ops::Deref<Target = ImageHash>>(hashes: &[H]) -> HashMatrix {
+        let words = hashes.first().map_or(0, |h| h.bits.len());
+        let mut data = Vec::with_capacity(words * hashes.len());
+        for hash in hashes {
+            data.extend_from_slice(&hash.bits);
+        }
+
+        HashMatrix {
+            data,
+            words,
+            len: hashes.len(),
+        }
+    }
+
+    fn len(&self) -> usize {
+        self.len
+    }
+}
+
+impl std::ops::Index<usize> for HashMatrix {
+    type Output = [u64];
+
+    fn index(&self, i: usize) -> &[u64] {
+        &self.data[i * self.words..(i + 1) * self.words]
+    }
+}
+
+// BK-tree over indices of `hashes`. Hamming distance is a metric, so a query
+// only needs to descend into children whose edge distance is within the
+// threshold of the distance to their parent.
+struct BKTree<'a> {
+    hashes: &'a HashMatrix,
+    // Each node is a hash index and its children as (edge distance, node).
+    nodes: Vec<(usize, Vec<(u32, usize)>)>,
+}
+
+impl<'a> BKTree<'a> {
+    fn new(hashes: &'a HashMatrix) -> BKTree<'a> {
+        let mut tree = BKTree {
+            hashes,
+            nodes: Vec::with_capacity(hashes.len()),
+        };
+        for i in 0..hashes.len() {
+            tree.insert(i);
+        }
+        tree
+    }
+
+    fn insert(&mut self, index: usize) {
+        if self.nodes.is_empty() {
+            self.nodes.push((index, Vec::new()));
+            return;
+        }
+
+        let hashes = self.hashes;
+        let target = &hashes[index];
+        let mut current = 0;
+        loop {
+            let distance = hamming(&hashes[self.nodes[current].0], target);
+            match self.nodes[current]
+                .1
+                .iter()
+                .find(|(edge, _)| *edge == distance)
+            {
+                Some(&(_, child)) => current = child,
+                None => {
+                    let node = self.nodes.len();
+                    self.nodes[current].1.push((distance, node));
+                    self.nodes.push((index, Vec::new()));
+                    return;
+                }
+            }
+        }
+    }
+
+    // Returns the indices of every hash at most `max_bits` bits away from `target`.
+    fn query(&self, target: &[u64], max_bits: u32) -> Vec<usize> {
+        let mut found = Vec::new();
+        if self.nodes.is_empty() {
+            return found;
+        }
+
+        let mut stack = vec![0];
+        while let Some(current) = stack.pop() {
+            let (index, children) = &self.nodes[current];
+            let distance = hamming(&self.hashes[*index], target);
+            if distance <= max_bits {
+                found.push(*index);
+            }
+
+            for &(edge, child) in children {
+                if edge.abs_diff(distance) <= max_bits {
+                    stack.push(child);
+                }
+            }
+        }
+        found
+    }
+}
+
+// Bands narrower than this match by chance too often for bucketing to pay off.
+const MIN_BAND_BITS: usize = 16;
+// Every band keeps a bucket entry per hash, so past this many bands the
+// index would use far more memory than a BK-tree.
+const MAX_BANDS: usize = 16;
+
+// Copies bits `start..end` of `bits` into their own words.
+fn bit_range(bits: &[u64], start: usize, end: usize) -> Vec<u64> {
+    let mut range = vec![0u64; (end - start + 63) / 64];
+    for c in start..end {
+        if (bits[c / 64] >> (c % 64)) & 1 == 1 {
+            let k = c - start;
+            range[k / 64] |= 1 << (k % 64);
+        }
+    }
+    range
+}
+
+// Groups hashes by the value of each of `band_count` bands. Hashes less than
+// `band_count` bits apart cannot differ in every band, so looking through the
+// buckets a hash falls in finds all of its duplicates.
+struct Bands<'a> {
+    hashes: &'a HashMatrix,
+    // `buckets[band][bucket_of[band][i]]` lists, in increasing order, the hashes
+    // sharing that band with hash `i`.
+    bucket_of: Vec<Vec<usize>>,
+    buckets: Vec<Vec<Vec<usize>>>,
+}
+
+impl<'a> Bands<'a> {
+    fn new(hashes: &'a HashMatrix, hash_bits: usize, band_count: usize) -> Bands<'a> {
+        let (bucket_of, buckets) = (0..band_count)
+            .into_par_iter()
+            .map(|band| {
+                let start = band * hash_bits / band_count;
+                let end = (band + 1) * hash_bits / band_count;
+
+                let mut ids: HashMap<Vec<u64>, usize> = HashMap::new();
+                let mut bucket_of = Vec::with_capacity(hashes.len());
+                let mut buckets: Vec<Vec<usize>> = Vec::new();
+                for i in 0..hashes.len() {
+                    let id = *ids
+                        .entry(bit_range(&hashes[i], start, end))
+                        .or_insert_with(|| {
+                            buckets.push(Vec::new());
+                            buckets.len() - 1
+                        });
+                    buckets[id].push(i);
+                    bucket_of.push(id);
+                }
+                (bucket_of, buckets)
+            })
+            .unzip();
+
+        Bands {
+            hashes,
+            bucket_of,
+            buckets,
+        }
+    }
+
+    // Finds the hashes after hash `i` that are at most `max_bits` bits away,
+    // in increasing order.
+    fn query(&self, i: usize, max_bits: u32) -> Vec<usize> {
+        let target = &self.hashes[i];
+        let mut found = Vec::new();
+        for (bucket_of, buckets) in self.bucket_of.iter().zip(&self.buckets) {
+            let bucket = &buckets[bucket_of[i]];
+            let later = &bucket[bucket.partition_point(|&j| j <= i)..];
+            found.extend(
+                later
+                    .iter()
+                    .copied()
+                    .filter(|&j| hamming(target, &self.hashes[j]) <= max_bits),
+            );
         }
+        // A pair sharing several bands is found once per band.
+        found.sort_unstable();
+        found.dedup();
+        found
+    }
+}
 
-        Ok(count)
+// Where find_duplicate_indices gets its candidates from.
+enum Index<'a> {
+    Bands(Bands<'a>),
+    Tree(BKTree<'a>),
+}
+
+impl<'a> Index<'a> {
+    // Uses bands when there are few enough of them and they are wide enough to
+    // be selective, otherwise a BK-tree.
+    fn new(hashes: &'a HashMatrix, hash_bits: usize, max_bits: u32) -> Index<'a> {
+        let band_count = max_bits as usize + 1;
+        if band_count <= MAX_BANDS && hash_bits / band_count >= MIN_BAND_BITS {
+            Index::Bands(Bands::new(hashes, hash_bits, band_count))
+        } else {
+            Index::Tree(BKTree::new(hashes))
+        }
+    }
+
+    // Finds the hashes after hash `i` that are at most `max_bits` bits away,
+    // in increasing order.
+    fn query(&self, i: usize, max_bits: u32) -> Vec<usize> {
+        match self {
+            Index::Bands(bands) => bands.query(i, max_bits),
+            Index::Tree(tree) => {
+                let mut found: Vec<usize> = tree
+                    .query(&tree.hashes[i], max_bits)
+                    .into_iter()
+                    .filter(|&j| j > i)
+                    .collect();
+                found.sort_unstable();
+                found
+            }
+        }
     }
 }
 
+// Files larger than this are decoded through a bigger read buffer, so that
+// decoding them takes fewer read syscalls.
+const LARGE_FILE_SIZE: u64 = 8 * 1024 * 1024;
+const LARGE_FILE_BUFFER: usize = 64 * 1024;
+const DEFAULT_FILE_BUFFER: usize = 8 * 1024;
+
+// Same as `image::open`, but picks the read buffer size based on the file size.
+fn open_image(fpath: String) -> anyhow::Result<DynamicImage> {
+    let file = File::open(&fpath)?;
+    let capacity = if file.metadata()?.len() > LARGE_FILE_SIZE {
+        LARGE_FILE_BUFFER
+    } else {
+        DEFAULT_FILE_BUFFER
+    };
+
+    let mut reader = image::io::Reader::new(BufReader::with_capacity(capacity, file));
+    reader.set_format(ImageFormat::from_path(&fpath)?);
+    Ok(reader.decode()?)
+}
+
 // Hashes an image using average hash
-#[pyfunction]
-fn ahash(fpath: String, hash_size: u32) -> PyResult<ImageHash> {
-    let img = match image::open(fpath) {
+fn ahash_impl(fpath: String, hash_size: u32) -> PyResult<ImageHash> {
+    let img = match open_image(fpath) {
         Ok(im) => im,
         Err(_e) => return Err(PyValueError::new_err("Cannot open image.")),
     };
@@ -60,29 +371,18 @@ fn ahash(fpath: String, hash_size: u32) -> PyResult<ImageHash> {
         resized.pixels().map(|px| px.0[0] as f64).sum::<f64>() / resized.pixels().len() as f64;
 
     let mut bool_result = vec![false; hashpow as usize];
-    let mut result: Vec<u8> = vec![0; (hashpow / 8) as usize];
 
     for (c, px) in resized.pixels().enumerate() {
         let cmp = px.0[0] as f64 > avg;
         bool_result[c] = cmp;
-        if cmp {
-            result[c / 8] |= 1 << (c % 8);
-        } else {
-            result[c / 8] |= 0 << (c % 8);
-        }
     }
 
-    Ok(ImageHash {
-        bool_values: bool_result,
-        values: result,
-        hash_size: hash_size as usize,
-    })
+    Ok(ImageHash::from_bools(&bool_result, hash_size as usize))
 }
 
 // Hashes an image using perceptual hash
-#[pyfunction]
-fn phash(fpath: String, hash_size: u32, highfreq_factor: u32) -> PyResult<ImageHash> {
-    let img = match image::open(fpath) {
+fn phash_impl(fpath: String, hash_size: u32, highfreq_factor: u32) -> PyResult<ImageHash> {
+    let img = match open_image(fpath) {
         Ok(im) => im,
         Err(_e) => return Err(PyValueError::new_err("Cannot open image.")),
     };
@@ -119,32 +419,21 @@ fn phash(fpath: String, hash_size: u32, highfreq_factor: u32) -> PyResult<ImageH
     let avg = dct_arr.iter().flat_map(|row| row.iter()).sum::<f64>() / hashpow as f64;
 
     let mut bool_result = vec![false; hashpow as usize];
-    let mut result: Vec<u8> = vec![0; (hashpow / 8) as usize];
 
     for i in 0..hash_size {
         for j in 0..hash_size {
             let c = (i * hash_size + j) as usize;
             let cmp = dct_arr[i as usize][j as usize] > avg;
             bool_result[c] = cmp;
-            if cmp {
-                result[c / 8] |= 1 << (c % 8);
-            } else {
-                result[c / 8] |= 0 << (c % 8);
-            }
         }
     }
 
-    Ok(ImageHash {
-        bool_values: bool_result,
-        values: result,
-        hash_size: hash_size as usize,
-    })
+    Ok(ImageHash::from_bools(&bool_result, hash_size as usize))
 }
 
 // Hashes an image using difference hash
-#[pyfunction]
-fn dhash(fpath: String, hash_size: u32) -> PyResult<ImageHash> {
-    let img = match image::open(fpath) {
+fn dhash_impl(fpath: String, hash_size: u32) -> PyResult<ImageHash> {
+    let img = match open_image(fpath) {
         Ok(im) => im,
         Err(_e) => return Err(PyValueError::new_err("Cannot open image.")),
     };
@@ -158,7 +447,6 @@ fn dhash(fpath: String, hash_size: u32) -> PyResult<ImageHash> {
 
     let hashpow = hash_size.pow(2);
     let mut bool_result = vec![false; hashpow as usize];
-    let mut result: Vec<u8> = vec![0; (hashpow / 8) as usize];
 
     let mut y = 0;
     while y < hash_size {
@@ -170,21 +458,95 @@ fn dhash(fpath: String, hash_size: u32) -> PyResult<ImageHash> {
 
             let cmp = left_pixel > right_pixel;
             bool_result[c] = cmp;
-            if cmp {
-                result[c / 8] |= 1 << (c % 8);
-            } else {
-                result[c / 8] |= 0 << (c % 8);
-            }
 
             x += 1;
         }
         y += 1;
     }
 
-    Ok(ImageHash {
-        bool_values: bool_result,
-        values: result,
-        hash_size: hash_size as usize,
+    Ok(ImageHash::from_bools(&bool_result, hash_size as usize))
+}
+
+// Hashing does not touch any Python object, so the GIL is released while the
+// image is decoded and hashed to let other threads run in the meantime.
+#[pyfunction]
+fn ahash(py: Python, fpath: String, hash_size: u32) -> PyResult<ImageHash> {
+    py.allow_threads(move || ahash_impl(fpath, hash_size))
+}
+
+#[pyfunction]
+fn phash(py: Python, fpath: String, hash_size: u32, highfreq_factor: u32) -> PyResult<ImageHash> {
+    py.allow_threads(move || phash_impl(fpath, hash_size, highfreq_factor))
+}
+
+#[pyfunction]
+fn dhash(py: Python, fpath: String, hash_size: u32) -> PyResult<ImageHash> {
+    py.allow_threads(move || dhash_impl(fpath, hash_size))
+}
+
+// How often find_duplicate_indices reports its progress back to Python.
+const PROGRESS_INTERVAL: Duration = Duration::from_millis(50);
+
+// For every hash, finds the indices of the hashes after it that are at most
+// `max_bits` bits away. Candidates come from band bucketing when there are few
+// bands, wide enough to be selective, otherwise from a BK-tree. Either way they are
+// checked in parallel without the GIL. Meanwhile the calling thread calls
+// `increment_func` with the number of hashes checked since its last call, every
+// PROGRESS_INTERVAL and once more at the end.
+#[pyfunction]
+fn find_duplicate_indices(
+    py: Python,
+    hashes: Vec<PyRef<ImageHash>>,
+    max_bits: u32,
+    increment_func: Option<PyObject>,
+) -> PyResult<Vec<(usize, Vec<usize>)>> {
+    if hashes.windows(2).any(|w| w[0].hash_size != w[1].hash_size) {
+        return Err(PyValueError::new_err("Unmatch size"));
+    }
+
+    let hash_bits = hashes.first().map_or(0, |h| h.hash_size.pow(2));
+    let packed = HashMatrix::new(&hashes);
+    py.allow_threads(move || {
+        let index = Index::new(&packed, hash_bits, max_bits);
+
+        let checked = AtomicUsize::new(0);
+        let (sender, receiver) = mpsc::channel();
+        thread::scope(|scope| {
+            let (index, packed, checked) = (&index, &packed, &checked);
+            scope.spawn(move || {
+                let found: Vec<(usize, Vec<usize>)> = (0..packed.len())
+                    .into_par_iter()
+                    .map(|i| {
+                        let hits = index.query(i, max_bits);
+                        checked.fetch_add(1, Ordering::Relaxed);
+                        (i, hits)
+                    })
+                    .collect();
+                // Only fails if the receiving side already gave up on an error.
+                let _ = sender.send(found);
+            });
+
+            // Python is only called from this thread, and only takes the GIL
+            // once per interval rather than once per hash.
+            let mut reported = 0;
+            loop {
+                let received = receiver.recv_timeout(PROGRESS_INTERVAL);
+                if let Some(func) = &increment_func {
+                    let current = checked.load(Ordering::Relaxed);
+                    if current > reported {
+                        Python::with_gil(|py| func.call1(py, (current - reported,)))?;
+                        reported = current;
+                    }
+                }
+
+                match received {
+                    Ok(found) => return Ok(found),
+                    Err(RecvTimeoutError::Timeout) => continue,
+                    // The search panicked, the scope rethrows it once joined.
+                    Err(RecvTimeoutError::Disconnected) => return Ok(Vec::new()),
+                }
+            }
+        })
     })
 }
 
@@ -195,5 +557,114 @@ fn dif(_py: Python, m: &PyModule) -> PyResult<()> {
     m.add_function(wrap_pyfunction!(ahash, m)?)?;
     m.add_function(wrap_pyfunction!(dhash, m)?)?;
     m.add_function(wrap_pyfunction!(phash, m)?)?;
+    m.add_function(wrap_pyfunction!(find_duplicate_indices, m)?)?;
     Ok(())
 }
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    // xorshift64, so the tests need no extra dependency and always see the same hashes.
+    fn random_words(seed: &mut u64, count: usize) -> Vec<u64> {
+        (0..count)
+            .map(|_| {
+                *seed ^= *seed << 13;
+                *seed ^= *seed >> 7;
+                *seed ^= *seed << 17;
+                *seed
+            })
+            .collect()
+    }
+
+    // Clusters of hashes a few bits apart, so every max_bits has some hits.
+    fn random_hashes(hash_size: usize) -> Vec<ImageHash> {
+        let hash_bits = hash_size.pow(2);
+        let mut seed = 0x9E37_79B9_7F4A_7C15;
+        let mut hashes = Vec::new();
+        for _ in 0..40 {
+            let mut center = random_words(&mut seed, (hash_bits + 63) / 64);
+            // Bits past the end of the hash are always 0.
+            if hash_bits % 64 != 0 {
+                *center.last_mut().unwrap() &= (1 << (hash_bits % 64)) - 1;
+            }
+            for _ in 0..8 {
+                let mut bits = center.clone();
+                for r in random_words(&mut seed, 6) {
+                    let c = (r % hash_bits as u64) as usize;
+                    bits[c / 64] ^= 1 << (c % 64);
+                }
+                hashes.push(ImageHash { bits, hash_size });
+            }
+        }
+        hashes
+    }
+
+    fn brute_force(hashes: &HashMatrix, i: usize, max_bits: u32) -> Vec<usize> {
+        (i + 1..hashes.len())
+            .filter(|&j| hamming(&hashes[i], &hashes[j]) <= max_bits)
+            .collect()
+    }
+
+    #[test]
+    fn indexes_match_brute_force() {
+        for hash_size in [8, 16, 64] {
+            let hashes = random_hashes(hash_size);
+            let refs: Vec<&ImageHash> = hashes.iter().collect();
+            let packed = HashMatrix::new(&refs);
+            let tree = BKTree::new(&packed);
+            let hash_bits = hash_size.pow(2);
+
+            // Covers both sides of the MIN_BAND_BITS and MAX_BANDS switches for
+            // each hash size, 204 being a 0.95 similarity with a hash size of 64.
+            for max_bits in [0, 1, 2, 3, 4, 5, 8, 15, 16, 20, 204] {
+                let bands = Bands::new(&packed, hash_bits, max_bits as usize + 1);
+                let index = Index::new(&packed, hash_bits, max_bits);
+                for i in 0..packed.len() {
+                    let expected = brute_force(&packed, i, max_bits);
+
+                    assert_eq!(index.query(i, max_bits), expected);
+                    assert_eq!(bands.query(i, max_bits), expected);
+
+                    let mut found: Vec<usize> = tree
+                        .query(&packed[i], max_bits)
+                        .into_iter()
+                        .filter(|&j| j > i)
+                        .collect();
+                    found.sort_unstable();
+                    assert_eq!(found, expected);
+                }
+            }
+        }
+    }
+
+    #[test]
+    fn index_uses_few_wide_bands() {
+        let packed = HashMatrix::new::<&ImageHash>(&[]);
+        let uses_bands = |hash_size: usize, max_bits: u32| {
+            matches!(
+                Index::new(&packed, hash_size.pow(2), max_bits),
+                Index::Bands(_)
+            )
+        };
+
+        assert!(uses_bands(8, 3));
+        assert!(!uses_bands(8, 4));
+        assert!(uses_bands(16, 15));
+        assert!(!uses_bands(16, 16));
+        assert!(uses_bands(64, 15));
+        assert!(!uses_bands(64, 16));
+        assert!(!uses_bands(64, 204));
+    }
+
+    #[test]
+    fn bytes_round_trip() {
+        for hash_size in [4, 8, 12, 16] {
+            for hash in random_hashes(hash_size).iter().take(8) {
+                let decoded = ImageHash::from_bytes(&hash.bytes(), hash_size).unwrap();
+                assert_eq!(decoded.bits, hash.bits);
+                assert_eq!(decoded.hash_size, hash.hash_size);
+            }
+        }
+    }
+}
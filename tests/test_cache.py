@@ -0,0 +1,105 @@
+import os
+import sqlite3
+from pathlib import Path
+from typing import List
+
+import pytest
+
+from dif import ImageHash
+from dif.cache import HashCache
+from dif.finder import get_hashes
+
+
+@pytest.fixture
+def cache_path(tmp_path: Path) -> str:
+    return str(tmp_path / "cache" / "hashes.sqlite")
+
+
+@pytest.fixture
+def image(tmp_path: Path) -> str:
+    path = tmp_path / "a.png"
+    path.write_bytes(b"not decoded by the cache")
+    return str(path)
+
+
+def make_hash(hash_size: int = 8) -> ImageHash:
+    return ImageHash.from_bytes(bytes(range(hash_size**2 // 8)), hash_size)
+
+
+def test_round_trip(cache_path: str, image: str):
+    with HashCache(cache_path) as cache:
+        cache.set(image, 8, "ahash", make_hash())
+        cached = cache.get(image, 8, "ahash")
+
+    assert cached is not None
+    assert cached.to_bytes() == make_hash().to_bytes()
+
+
+def test_persists_after_close(cache_path: str, image: str):
+    with HashCache(cache_path) as cache:
+        cache.set(image, 8, "ahash", make_hash())
+
+    with HashCache(cache_path) as cache:
+        assert cache.get(image, 8, "ahash") is not None
+
+
+def test_changed_mtime_is_a_miss(cache_path: str, image: str):
+    with HashCache(cache_path) as cache:
+        cache.set(image, 8, "ahash", make_hash())
+        stat = os.stat(image)
+        os.utime(image, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+        assert cache.get(image, 8, "ahash") is None
+
+
+def test_changed_size_is_a_miss(cache_path: str, image: str):
+    with HashCache(cache_path) as cache:
+        cache.set(image, 8, "ahash", make_hash())
+        stat = os.stat(image)
+        with open(image, "ab") as f:
+            f.write(b"more")
+        os.utime(image, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+        assert cache.get(image, 8, "ahash") is None
+
+
+def test_other_hash_size_or_algo_is_a_miss(cache_path: str, image: str):
+    with HashCache(cache_path) as cache:
+        cache.set(image, 8, "ahash", make_hash())
+
+        assert cache.get(image, 16, "ahash") is None
+        assert cache.get(image, 8, "dhash") is None
+
+
+def test_corrupted_hash_is_a_miss(cache_path: str, image: str):
+    with HashCache(cache_path) as cache:
+        cache.set(image, 8, "ahash", make_hash())
+
+    conn = sqlite3.connect(cache_path)
+    with conn:
+        conn.execute("UPDATE hashes SET hash = ?", (b"\x00",))
+    conn.close()
+
+    with HashCache(cache_path) as cache:
+        assert cache.get(image, 8, "ahash") is None
+
+
+def test_get_hashes_skips_cached_images(cache_path: str, image: str):
+    calls: List[str] = []
+
+    def counting_hash(file_path: str, hash_size: int) -> ImageHash:
+        calls.append(file_path)
+        return make_hash(hash_size)
+
+    with HashCache(cache_path) as cache:
+        first = get_hashes([image], 8, counting_hash, cache=cache, cache_key="test")
+        second = get_hashes([image], 8, counting_hash, cache=cache, cache_key="test")
+
+    assert calls == [image]
+    assert first[image].to_bytes() == second[image].to_bytes()
+
+
+def test_cache_requires_a_key(cache_path: str, image: str):
+    with HashCache(cache_path) as cache:
+        with pytest.raises(ValueError):
+            get_hashes([image], 8, lambda *_: make_hash(), cache=cache)
@@ -0,0 +1,85 @@
+import functools
+from pathlib import Path
+from typing import List
+
+from dif import ImageHash, dhash
+from dif.finder import find_duplicates, get_hashes
+
+
+def make_hash(*set_bits: int, hash_size: int = 8) -> ImageHash:
+    data = bytearray(hash_size**2 // 8)
+    for bit in set_bits:
+        data[bit // 8] |= 1 << (bit % 8)
+    return ImageHash.from_bytes(bytes(data), hash_size)
+
+
+def write_image(path: Path) -> str:
+    # A 2x2 grayscale PGM, the simplest format the image crate decodes.
+    path.write_bytes(b"P5\n2 2\n255\n" + bytes([0, 255, 255, 0]))
+    return str(path)
+
+
+def test_two_identical_images_are_duplicates():
+    hashes = {"a.png": make_hash(1, 2, 3), "b.png": make_hash(1, 2, 3)}
+
+    assert find_duplicates(["a.png", "b.png"], hashes, 8, 0.1) == {"a.png": ["b.png"]}
+
+
+def test_two_different_images_are_not_duplicates():
+    hashes = {"a.png": make_hash(), "b.png": make_hash(*range(32))}
+
+    assert find_duplicates(["a.png", "b.png"], hashes, 8, 0.1) == {}
+
+
+def test_unhashed_images_are_skipped_and_counted():
+    hashes = {"a.png": make_hash(), "b.png": None, "c.png": make_hash()}
+    progress: List[int] = []
+
+    duplicates = find_duplicates(
+        ["a.png", "b.png", "c.png"], hashes, 8, 0.1, increment_func=progress.append
+    )
+
+    assert duplicates == {"a.png": ["c.png"]}
+    assert sum(progress) == 3
+
+
+def test_threshold_is_exclusive():
+    # 6 of 64 bits differ.
+    hashes = {"a.png": make_hash(), "b.png": make_hash(*range(6))}
+
+    assert find_duplicates(["a.png", "b.png"], hashes, 8, 7 / 64) == {
+        "a.png": ["b.png"]
+    }
+    assert find_duplicates(["a.png", "b.png"], hashes, 8, 6 / 64) == {}
+
+
+def test_zero_threshold_matches_identical_hashes():
+    hashes = {"a.png": make_hash(5), "b.png": make_hash(5), "c.png": make_hash(6)}
+
+    assert find_duplicates(["a.png", "b.png", "c.png"], hashes, 8, 0) == {
+        "a.png": ["b.png"]
+    }
+
+
+def test_failed_hashes_are_none():
+    def broken_hash(file_path: str, hash_size: int) -> ImageHash:
+        raise ValueError("Cannot open image.")
+
+    assert get_hashes(["a.png"], 8, broken_hash) == {"a.png": None}
+
+
+def test_panicking_hashes_are_none(tmp_path: Path):
+    image = write_image(tmp_path / "a.pgm")
+
+    # dhash panics on hash sizes below 8, which surfaces as a BaseException.
+    hashes = get_hashes([image], 4, dhash)
+
+    assert hashes == {image: None}
+    assert get_hashes([image], 8, dhash)[image] is not None
+
+
+def test_hash_func_can_be_any_callable(tmp_path: Path):
+    image = write_image(tmp_path / "a.pgm")
+    hash_func = functools.partial(dhash)
+
+    assert get_hashes([image], 8, hash_func)[image] is not None
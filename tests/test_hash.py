@@ -0,0 +1,27 @@
+import pytest
+
+from dif import ImageHash
+
+
+def make_hash(seed: int, hash_size: int = 8) -> ImageHash:
+    data = bytes((seed * 37 + k * 11) % 256 for k in range(hash_size**2 // 8))
+    return ImageHash.from_bytes(data, hash_size)
+
+
+def test_distances_match_distance():
+    base = make_hash(0)
+    others = [make_hash(seed) for seed in range(10)]
+
+    assert base.distances(others) == [base.distance(o) for o in others]
+
+
+def test_distances_of_nothing():
+    assert make_hash(0).distances([]) == []
+
+
+def test_distances_reject_other_sizes():
+    with pytest.raises(ValueError):
+        make_hash(0).distances([make_hash(1), make_hash(2, hash_size=16)])
+
+    with pytest.raises(ValueError):
+        make_hash(0).distance(make_hash(2, hash_size=16))